@@ -1,23 +1,15 @@
-import os, re, time
+import hashlib
+import io, json, os, re, time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import date, timedelta
 import pandas as pd
 import streamlit as st
-
-# ========== EMBED NO LOOKER STUDIO ==========
-try:
-    from streamlit.web.server import websocket_headers as wh
-    _orig_get = wh._get_websocket_headers
-    def _patched_get(*args, **kwargs):
-        headers = _orig_get(*args, **kwargs)
-        headers["Content-Security-Policy"] = (
-            "frame-ancestors 'self' https://lookerstudio.google.com https://datastudio.google.com"
-        )
-        headers.pop("X-Frame-Options", None)
-        return headers
-    wh._get_websocket_headers = _patched_get
-except Exception:
-    pass
-# ============================================
+from llm_cache import cached_chat, cache_key, cache_get, cache_put
+from sql_helpers import (
+    sanitize_sql, sql_is_safe, ensure_limit, normalize_sql, optimize_projection,
+)
+import semantic_cache
+import embed_patch  # noqa: F401  (patch de headers para embed no Looker Studio)
 
 st.set_page_config(page_title="GSC → BigQuery: Chat de Dados", layout="wide")
 
@@ -39,33 +31,125 @@ if not OPENAI_KEY:
     st.warning("Defina OPENAI_API para habilitar a IA.")
 
 # --------- Credencial GCP ---------
-if SA_JSON:
-    SA_PATH = "/tmp/sa.json"
-    with open(SA_PATH, "w") as f:
-        f.write(SA_JSON)
+# escrita idempotente: o caminho carrega o hash do conteúdo, então reruns não
+# reescrevem o mesmo arquivo nem mutam os.environ; credencial já apontada
+# externamente tem prioridade
+if SA_JSON and not os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"):
+    SA_PATH = f"/tmp/sa_{hashlib.blake2b(SA_JSON.encode(), digest_size=8).hexdigest()}.json"
+    if not os.path.exists(SA_PATH):
+        with open(SA_PATH, "w") as f:
+            f.write(SA_JSON)
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SA_PATH
 
-# --------- BigQuery ---------
-from google.cloud import bigquery
+# --------- BigQuery (import adiado: só paga o custo quando há credencial) ---------
+@st.cache_resource(show_spinner=False)
+def get_bq():
+    from google.cloud import bigquery
+    return bigquery.Client()
+
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    """Pool compartilhado para sobrepor as esperas de rede (LLM, BQ, embeddings)."""
+    return ThreadPoolExecutor(max_workers=4)
+
 @st.cache_resource(show_spinner=False)
-def get_bq(): return bigquery.Client()
-bq = get_bq() if SA_JSON else None
+def get_bqstorage():
+    """Cliente do Storage Read API (Arrow) — download colunar, sem JSON."""
+    from google.cloud import bigquery_storage
+    return bigquery_storage.BigQueryReadClient()
+
+SCHEMA_TTL = int(os.getenv("SCHEMA_CACHE_TTL", "86400"))
+
+# persist="disk" ignora o ttl no Streamlit 1.37 (a entrada persistida nunca
+# expira), então o carimbo de frescor vai DENTRO do valor cacheado e o
+# wrapper abaixo força o refetch quando ele vence — cold start continua sem
+# RPC e mudanças de DDL aparecem dentro do TTL
+@st.cache_data(show_spinner=False, persist="disk")
+def _table_schema_snapshot(table_fqn: str):
+    tbl = get_bq().get_table(table_fqn)
+    return time.time(), [(s.name, s.field_type) for s in tbl.schema]
 
-@st.cache_data(show_spinner=False)
 def get_table_schema(table_fqn: str):
-    tbl = bq.get_table(table_fqn)
-    return [(s.name, s.field_type) for s in tbl.schema]
+    """Schema da tabela: persistido em disco (restart sem get_table) e
+    renovado quando o carimbo do snapshot passa de SCHEMA_TTL."""
+    fetched_at, schema = _table_schema_snapshot(table_fqn)
+    if time.time() - fetched_at > SCHEMA_TTL:
+        _table_schema_snapshot.clear()
+        _, schema = _table_schema_snapshot(table_fqn)
+    return schema
+
+@st.cache_data(show_spinner=False, ttl=int(os.getenv("SQL_CACHE_TTL", "3600")), max_entries=128)
+def run_sql(sql_norm: str) -> pd.DataFrame:
+    """Executa a SQL no BigQuery com cache por texto normalizado da consulta.
+
+    A mesma SQL dentro de 1h volta do cache do Streamlit (sem novo scan no
+    BigQuery nem nova materialização do DataFrame). O download usa o Storage
+    Read API (lotes Arrow via gRPC); self_destruct libera os buffers Arrow
+    durante a conversão em vez de manter duas cópias dos dados na memória.
+    """
+    job = get_bq().query(sql_norm, job_config=_job_cfg())
+    try:
+        rows = job.result(timeout=float(os.getenv("BQ_TIMEOUT", "30")))
+    except FutureTimeoutError:
+        job.cancel()  # libera o slot; sem isso o job seguiria rodando (e cobrando)
+        raise TimeoutError(
+            "A consulta excedeu o tempo limite; reformule com filtros mais restritos."
+        )
+    tbl = rows.to_arrow(bqstorage_client=get_bqstorage(), progress_bar_type=None)
+    return tbl.to_pandas(self_destruct=True)
+
+MAX_SCAN_BYTES = int(os.getenv("MAX_SCAN_BYTES", 5_000_000_000))
+
+# config única para todas as execuções: cache de resultado do próprio BigQuery
+# (SQL idêntica em 24h volta em ~100ms, custo zero) + teto de bytes faturados
+@st.cache_resource(show_spinner=False)
+def _job_cfg():
+    from google.cloud import bigquery
+    return bigquery.QueryJobConfig(
+        use_query_cache=True,
+        use_legacy_sql=False,
+        maximum_bytes_billed=int(os.getenv("MAX_BYTES_BILLED", 10_000_000_000)),
+        priority=bigquery.QueryPriority.INTERACTIVE,
+    )
+
+def dry_run_bytes(sql: str) -> int:
+    """Dry-run no BigQuery: estima bytes escaneados sem executar (custo zero)."""
+    from google.cloud import bigquery
+    job = get_bq().query(sql, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=True))
+    return job.total_bytes_processed or 0
+
+# --------- OpenAI (sem proxies; import adiado quando não há chave) ---------
+@st.cache_resource(show_spinner=False)
+def get_openai():
+    """Cliente OpenAI compartilhado entre sessões/reruns: o pool TCP/TLS
+    sobrevive ao ciclo de execução do Streamlit (sem novo handshake)."""
+    if not OPENAI_KEY:
+        return None
+    import httpx
+    from openai import OpenAI
+    # HTTP/2 + pool explícito: chamadas paralelas (SQL + resumo) multiplexam
+    # na mesma conexão em vez de serializar/refazer handshake TLS
+    http_client = httpx.Client(
+        http2=True,
+        # connect curto: host fora do ar falha em 5s em vez de segurar 60s
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        follow_redirects=True,
+        trust_env=False,
+        limits=httpx.Limits(max_keepalive_connections=10, max_connections=20, keepalive_expiry=60),
+    )
+    return OpenAI(api_key=OPENAI_KEY, http_client=http_client)
 
-# --------- OpenAI (sem proxies) ---------
-from openai import OpenAI
-import httpx
-client = None
-if OPENAI_KEY:
-    http_client = httpx.Client(timeout=60.0, follow_redirects=True, trust_env=False)
-    client = OpenAI(api_key=OPENAI_KEY, http_client=http_client)
+client = get_openai()
+
+# pré-aquece o schema em background no início do script: quando a primeira
+# pergunta chegar, o RPC get_table já aconteceu em paralelo com o render
+if SA_JSON and BQ_TABLE:
+    get_executor().submit(get_table_schema, BQ_TABLE)
 
 # --------- STYLE (tema claro, profissional) ---------
-st.markdown("""
+# string construída uma vez no import do módulo; cada rerun só repassa a
+# mesma referência ao st.markdown (sem reconstruir/concatenar o CSS)
+_PAGE_CSS = """
 <style>
 /* --- base branca --- */
 html, body, .stApp, [data-testid="stAppViewContainer"], .main {
@@ -112,20 +196,11 @@ button[kind]:hover,
   border-color:#cbd5e1 !important;
 }
 
-/* cartões e tipografia (mantém seu visual claro) */
-.qa-block{
+/* chat nativo (st.chat_message) com o mesmo visual claro dos cartões */
+[data-testid="stChatMessage"]{
   background:#ffffff; border:1px solid #e5e7eb; border-radius:16px;
-  padding:16px 18px; margin:14px 0; box-shadow:0 6px 18px rgba(31,41,55,.08);
-}
-.qa-head{ display:flex; align-items:center; gap:.5rem; margin-bottom:8px; }
-.qa-head .avatar{font-size:1.05rem}
-.qa-head .label{color:#6b7280; font-size:.82rem}
-.qa-time{ color:#6b7280; font-size:.8rem; margin-left:auto; }
-.qa-q{
-  background:#eef2ff; color:#111827; padding:10px 12px; border-radius:12px;
-  font-weight:600; margin-bottom:10px;
+  padding:12px 16px; margin:8px 0; box-shadow:0 6px 18px rgba(31,41,55,.08);
 }
-.qa-a{ color:#0f172a; font-size:.98rem; line-height:1.5rem; }
 
 .ask-card{
   background:#ffffff; border:1px solid #e5e7eb; border-radius:14px;
@@ -134,41 +209,48 @@ button[kind]:hover,
 .send-wrap { display:flex; gap:10px; align-items:stretch; }
 .send-wrap textarea{ min-height:56px; }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(_PAGE_CSS, unsafe_allow_html=True)
+
 
 
+# --------- Helpers: SQL (compartilhados em sql_helpers.py) ---------
 
-# --------- Helpers: SQL ---------
-def sanitize_sql(text: str) -> str:
-    if not text: return ""
-    t = text.strip()
-    t = re.sub(r"^sql\s*", "", t, flags=re.IGNORECASE)
-    t = re.sub(r"^```(?:sql)?\s*|\s*```$", "", t, flags=re.IGNORECASE | re.DOTALL)
-    m = re.search(r"\bselect\b", t, flags=re.IGNORECASE)
-    if m: t = t[m.start():]
-    return t.strip().rstrip(";")
+# núcleo sempre presente no prompt: dimensões/métricas que quase toda
+# pergunta de Search Console precisa, mesmo sem citar pelo nome
+_CORE_COLS = {"data_date", "clicks", "impressions", "sum_top_position", "device", "country"}
 
-def sql_is_safe(sql: str) -> bool:
-    s = sql.strip(); s_lower = s.lower()
-    if not re.match(r"^\s*select\b", s_lower): return False
-    forbidden = ["insert","update","delete","merge","drop","create","alter","truncate",";","--","/*"]
-    if any(tok in s_lower for tok in forbidden): return False
-    target_clean = re.sub(r"[`\s]", "", BQ_TABLE.lower())
-    s_clean = re.sub(r"[`\s]", "", s_lower)
-    return target_clean in s_clean
+def relevant_columns(question: str, columns: list) -> list:
+    """Filtra o schema para as colunas prováveis da pergunta.
 
-def ensure_limit(sql: str, default_limit: int = 1000) -> str:
-    return sql if re.search(r"\blimit\b\s+\d+\s*$", sql, re.I) else f"{sql}\nLIMIT {default_limit}"
+    Casamento barato de tokens entre pergunta e nome da coluna + núcleo
+    fixo: prompt menor (menos tokens de entrada, resposta mais rápida) e
+    menos colunas irrelevantes para o modelo escolher errado. Tabelas
+    pequenas passam inteiras — o corte só compensa com schema largo.
+    """
+    if len(columns) <= 12:
+        return columns
+    q_tokens = set(re.findall(r"\w+", question.lower()))
+    keep = [
+        (c, t) for c, t in columns
+        if c.lower() in _CORE_COLS or (set(c.lower().split("_")) & q_tokens)
+    ]
+    return keep or columns
 
 def build_sql_with_ai(question: str, table_fqn: str, columns: list) -> str:
     if not client: return ""
-    cols_txt = "\n".join([f"- {c} ({t})" for c, t in columns])
+    cols_txt = "\n".join([f"- {c} ({t})" for c, t in relevant_columns(question, columns)])
+    # saída JSON estruturada: o modelo não gasta tokens com cercas de código
+    # nem rótulos "sql:", e max_tokens limita o pior caso de geração
     system = (
         "Você é um gerador de SQL para BigQuery. "
-        "Responda SOMENTE com a consulta SQL (sem rótulos, sem explicações, sem cercas de código). "
+        'Responda SOMENTE com JSON no formato {"sql": "..."} contendo a consulta. '
         "Use exclusivamente a tabela e colunas fornecidas; não use outras tabelas, nem DDL/DML."
     )
-    user = (
+    # prefixo estável (tabela + colunas + regras) separado da pergunta:
+    # o cache de prefixo da OpenAI reaproveita esse trecho idêntico entre
+    # chamadas, cobrando menos tokens de entrada e reduzindo o TTFT
+    context = (
         f"Tabela alvo: `{table_fqn}`.\n"
         f"Colunas disponíveis:\n{cols_txt}\n\n"
         f"Regras específicas:\n"
@@ -176,20 +258,131 @@ def build_sql_with_ai(question: str, table_fqn: str, columns: list) -> str:
         f"- CTR = SAFE_DIVIDE(SUM(clicks), SUM(impressions)).\n"
         f"- Posição média = SAFE_DIVIDE(SUM(sum_top_position), SUM(impressions)) AS position.\n"
         f"- Ordene rankings por clicks ou impressions; limite resultados longos.\n"
-        f"- Comece diretamente com SELECT.\n\n"
-        f"Pergunta do usuário:\n{question}\n"
+        f"- Comece diretamente com SELECT.\n"
     )
-    resp = client.chat.completions.create(
+    content = cached_chat(
+        client,
+        [
+            {"role":"system","content":system},
+            {"role":"user","content":context},
+            {"role":"user","content":f"Pergunta do usuário:\n{question}\n"},
+        ],
         model=OPENAI_MODEL,
-        messages=[{"role":"system","content":system},{"role":"user","content":user}],
         temperature=0.1,
+        response_format={"type": "json_object"},
+        max_tokens=400,
     )
-    return sanitize_sql(resp.choices[0].message.content.strip())
+    try:
+        return sanitize_sql(str(json.loads(content).get("sql", "")))
+    except (ValueError, AttributeError):
+        return sanitize_sql(content)  # modelo fugiu do JSON: trata como texto
+
+def build_sqls_batch(questions: list, table_fqn: str, columns: list):
+    """Gera SQL para várias perguntas numa única chamada (rajada de envios).
 
-def ai_summary_paragraph(question: str, df: pd.DataFrame, sql_used: str) -> str:
+    Uma chamada com saída JSON amortiza RTT e fila da OpenAI quando o
+    micro-batch do rerun traz mais de uma pendência. Retorna a lista de
+    SQLs na ordem das perguntas, ou None — aí o fluxo cai no caminho
+    pergunta-a-pergunta normal.
+    """
+    if not client or len(questions) < 2:
+        return None
+    cols_txt = "\n".join([f"- {c} ({t})" for c, t in columns])
+    system = (
+        "Você é um gerador de SQL para BigQuery. "
+        'Responda SOMENTE com JSON no formato {"sqls": ["...", ...]}, '
+        "uma consulta SQL por pergunta, na mesma ordem das perguntas. "
+        "Use exclusivamente a tabela e colunas fornecidas; não use outras tabelas, nem DDL/DML."
+    )
+    context = (
+        f"Tabela alvo: `{table_fqn}`.\n"
+        f"Colunas disponíveis:\n{cols_txt}\n\n"
+        f"Regras específicas:\n"
+        f"- Se a pergunta não trouxer período, filtre os últimos 90 dias usando a coluna `data_date`.\n"
+        f"- CTR = SAFE_DIVIDE(SUM(clicks), SUM(impressions)).\n"
+        f"- Posição média = SAFE_DIVIDE(SUM(sum_top_position), SUM(impressions)) AS position.\n"
+        f"- Ordene rankings por clicks ou impressions; limite resultados longos.\n"
+        f"- Cada SQL começa diretamente com SELECT.\n"
+    )
+    try:
+        content = cached_chat(
+            client,
+            [
+                {"role": "system", "content": system},
+                {"role": "user", "content": context},
+                {"role": "user", "content": "Perguntas:\n" + json.dumps(questions, ensure_ascii=False)},
+            ],
+            model=OPENAI_MODEL,
+            temperature=0.1,
+            response_format={"type": "json_object"},
+        )
+        sqls = json.loads(content).get("sqls")
+        if isinstance(sqls, list) and len(sqls) == len(questions):
+            return [sanitize_sql(str(s)) for s in sqls]
+    except Exception:
+        pass
+    return None
+
+def df_digest(df: pd.DataFrame, n: int = 5) -> str:
+    """Resumo compacto do DataFrame para o prompt.
+
+    Estatísticas por coluna (sum/mean/min/max para numéricas, top-5 valores
+    para textuais) + n linhas representativas — tipicamente 3–10x menos
+    tokens do que o CSV bruto, com mais sinal para o modelo.
+    """
+    num = df.select_dtypes("number")
+    agg = num.agg(["sum", "mean", "min", "max"]).round(3).to_dict() if not num.empty else {}
+    top = {
+        c: df[c].astype(str).value_counts().head(5).to_dict()
+        for c in df.columns if c not in num.columns
+    }
+    # quantiza numéricos na amostra: menos casas decimais = menos tokens
+    sample_df = df.head(n).copy()
+    num_cols = sample_df.select_dtypes("number").columns
+    if len(num_cols):
+        sample_df[num_cols] = sample_df[num_cols].round(2)
+    sample = sample_df.to_dict(orient="records")
+    return json.dumps(
+        {"n_rows": len(df), "agregados": agg, "top_valores": top, "amostra": sample},
+        ensure_ascii=False, default=str,
+    )
+
+def sample_to_feather(df: pd.DataFrame, n: int = 300) -> bytes:
+    """Serializa a amostra como Arrow IPC (feather) em vez de list-of-dicts.
+
+    O session_state é pickleado a cada rerun; bytes Arrow são ~5-10x menores
+    que registros Python e a desserialização preserva os dtypes originais.
+    """
+    buf = io.BytesIO()
+    df.head(n).reset_index(drop=True).to_feather(buf)
+    return buf.getvalue()
+
+def sample_from_feather(blob, cols) -> pd.DataFrame:
+    if isinstance(blob, (bytes, bytearray)):
+        return pd.read_feather(io.BytesIO(blob))
+    return pd.DataFrame(blob, columns=cols)  # threads antigos (list-of-dicts)
+
+def _fmt_value(v) -> str:
+    if isinstance(v, float):
+        return f"{v:,.2f}"
+    if isinstance(v, int):
+        return f"{v:,}"
+    return str(v)
+
+def ai_summary_paragraph(question: str, df: pd.DataFrame, sql_used: str, placeholder=None) -> str:
     if not client: return "Defina OPENAI_API para habilitar a síntese de respostas."
     if df.empty:   return "Sem dados para o recorte solicitado."
-    preview = df.head(25).to_csv(index=False)
+    # resultados degenerados (agregado único, meia dúzia de linhas) não
+    # precisam de narrativa: formata determinístico e poupa o round-trip LLM
+    if df.shape == (1, 1):
+        return f"**{df.columns[0]}**: {_fmt_value(df.iat[0, 0])}"
+    if df.shape[0] <= 5 and df.shape[1] <= 3:
+        head = "| " + " | ".join(str(c) for c in df.columns) + " |"
+        sep = "|" + "---|" * len(df.columns)
+        body = ["| " + " | ".join(_fmt_value(v) for v in row) + " |"
+                for row in df.itertuples(index=False)]
+        return "\n".join([head, sep, *body])
+    preview = df_digest(df)
     system = (
         "Você é um analista de SEO especializado em Search Console no BigQuery. "
         "Escreva a resposta em tom profissional e humano, em 1–2 parágrafos curtos. "
@@ -199,104 +392,294 @@ def ai_summary_paragraph(question: str, df: pd.DataFrame, sql_used: str) -> str:
     user = (
         f"Pergunta do usuário:\n{question}\n\n"
         f"SQL executada (apenas contexto, não comente sobre ela):\n{sql_used}\n\n"
-        f"Prévia dos resultados (até 25 linhas em CSV):\n{preview}"
+        f"Resumo dos resultados (JSON: estatísticas por coluna + amostra):\n{preview}"
+    )
+    messages = [{"role":"system","content":system},{"role":"user","content":user}]
+    key = cache_key(messages, OPENAI_MODEL, 0.2)
+    hit = cache_get(key)
+    if hit is not None:
+        return hit
+    # stream=True: primeiros tokens aparecem em ~300ms em vez de esperar
+    # a geração inteira; o placeholder é atualizado a cada poucos tokens
+    acc = []
+    stream = client.chat.completions.create(
+        model=OPENAI_MODEL, messages=messages, temperature=0.2, stream=True,
     )
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content or ""
+        if delta:
+            acc.append(delta)
+            if placeholder is not None and len(acc) % 8 == 0:
+                placeholder.markdown("".join(acc))
+    text = "".join(acc).strip()
+    if placeholder is not None:
+        placeholder.markdown(text)
+    if text:
+        cache_put(key, text)
+    return text
+
+USE_TOOL_CALLS = os.getenv("USE_TOOL_CALLS", "0").strip() == "1"
+
+def answer_with_tools(question: str, schema_cols: list, placeholder=None):
+    """Pipeline fundido via function-calling: uma conversa só gera a SQL
+    (tool call), recebe o resultado do BigQuery e produz o resumo.
+
+    Em relação ao fluxo SQL-gen → resumo em prompts separados, o contexto
+    da segunda rodada já está montado (e com prefixo quente), cortando a
+    latência extra de RPC entre as duas chamadas. Retorna (answer, sql, df).
+    """
+    cols_txt = "\n".join(f"- {c} ({t})" for c, t in schema_cols)
+    tools = [{
+        "type": "function",
+        "function": {
+            "name": "run_bigquery_sql",
+            "description": "Executa uma consulta SELECT na tabela do Search Console e retorna um resumo dos dados.",
+            "parameters": {
+                "type": "object",
+                "properties": {"sql": {"type": "string", "description": "Consulta SELECT para BigQuery."}},
+                "required": ["sql"],
+            },
+        },
+    }]
+    messages = [
+        {"role": "system", "content": (
+            "Você é um analista de SEO com acesso à ferramenta run_bigquery_sql. "
+            "Gere a SQL via ferramenta e depois responda em 1–2 parágrafos curtos, "
+            "baseado apenas nos dados retornados."
+        )},
+        {"role": "user", "content": (
+            f"Tabela alvo: `{BQ_TABLE}`.\nColunas disponíveis:\n{cols_txt}\n\n"
+            f"Regras: sem período explícito, filtre os últimos 90 dias por `data_date`; "
+            f"CTR = SAFE_DIVIDE(SUM(clicks), SUM(impressions)); "
+            f"posição média = SAFE_DIVIDE(SUM(sum_top_position), SUM(impressions)).\n"
+        )},
+        {"role": "user", "content": f"Pergunta do usuário:\n{question}\n"},
+    ]
     resp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[{"role":"system","content":system},{"role":"user","content":user}],
-        temperature=0.2,
+        model=OPENAI_MODEL, messages=messages, tools=tools, temperature=0.1,
     )
-    return resp.choices[0].message.content.strip()
+    msg = resp.choices[0].message
+    if not msg.tool_calls:
+        return (msg.content or "").strip(), "", pd.DataFrame()
+    call = msg.tool_calls[0]
+    try:
+        sql = sanitize_sql(json.loads(call.function.arguments or "{}").get("sql", ""))
+    except Exception:
+        sql = ""
+    if not sql or not sql_is_safe(sql, BQ_TABLE):
+        return ("Não foi possível gerar uma consulta segura para essa pergunta. "
+                "Tente especificar período e/ou dimensões (meses, país, device)."), sql, pd.DataFrame()
+    sql = ensure_limit(optimize_projection(sql, BQ_TABLE, schema_cols))
+    scan_bytes = dry_run_bytes(sql)
+    if scan_bytes > MAX_SCAN_BYTES:
+        return (f"Consulta escanearia {scan_bytes/1e9:.1f} GB "
+                f"(limite {MAX_SCAN_BYTES/1e9:.1f} GB). Refine a pergunta."), sql, pd.DataFrame()
+    df = run_sql(normalize_sql(sql))
+    messages.append(msg)
+    messages.append({"role": "tool", "tool_call_id": call.id, "content": df_digest(df)})
+    final = client.chat.completions.create(model=OPENAI_MODEL, messages=messages, temperature=0.2)
+    answer = (final.choices[0].message.content or "").strip()
+    if placeholder is not None and answer:
+        placeholder.markdown(answer)
+    return answer, sql, df
 
 # --------- STATE ---------
 # thread: {"q":str,"a":str|None,"sql":str|None,"ts":float,"df_sample":list|None,"df_cols":list|None}
 if "threads" not in st.session_state:
     st.session_state.threads = []
-if "pending_index" not in st.session_state:
-    st.session_state.pending_index = None
+if "pending_indices" not in st.session_state:
+    st.session_state.pending_indices = []
 
-# --------- INPUT (topo): Enviar ao lado, Limpar link à direita ---------
-st.markdown('<div class="ask-card">', unsafe_allow_html=True)
-st.markdown('<div class="send-wrap">', unsafe_allow_html=True)
-col_input, col_send = st.columns([8, 1.6])
-with col_input:
-    question_text = st.text_area(
-        label=" ",
-        label_visibility="collapsed",
-        height=56,
-        placeholder="Ex.: Performance orgânica de agosto de 2025 para mobile"
+# histórico limitado: só as últimas MAX_LIVE_THREADS ficam em memória (rerun
+# fica O(1) no tamanho da sessão); o excedente vai para SQLite em disco
+MAX_LIVE_THREADS = int(os.getenv("MAX_LIVE_THREADS", "20"))
+HISTORY_DB = os.getenv("CHAT_HISTORY_PATH", "/tmp/gsc_chat_history.sqlite3")
+
+def archive_old_threads() -> None:
+    threads = st.session_state.threads
+    if len(threads) <= MAX_LIVE_THREADS:
+        return
+    import sqlite3
+    older = threads[MAX_LIVE_THREADS:]
+    con = sqlite3.connect(HISTORY_DB, timeout=5.0)
+    con.execute("CREATE TABLE IF NOT EXISTS history (ts REAL, q TEXT, a TEXT)")
+    con.executemany(
+        "INSERT INTO history (ts, q, a) VALUES (?, ?, ?)",
+        [(t["ts"], t["q"], t.get("a") or "") for t in older],
     )
-with col_send:
-    send = st.button("Enviar", use_container_width=True)
-st.markdown('</div>', unsafe_allow_html=True)
+    con.commit(); con.close()
+    st.session_state.threads = threads[:MAX_LIVE_THREADS]
 
-st.markdown('<div class="clear-wrap">', unsafe_allow_html=True)
-clear = st.button("Limpar", key="clear_btn")
-st.markdown('</div>', unsafe_allow_html=True)
-st.markdown('</div>', unsafe_allow_html=True)
+def load_archived_threads(limit: int = 100):
+    import sqlite3
+    try:
+        con = sqlite3.connect(HISTORY_DB, timeout=5.0)
+        rows = con.execute(
+            "SELECT ts, q, a FROM history ORDER BY ts DESC LIMIT ?", (limit,)
+        ).fetchall()
+        con.close()
+        return rows
+    except sqlite3.Error:
+        return []
 
-if clear:
-    st.session_state.threads = []
-    st.session_state.pending_index = None
-    st.rerun()
-
-# Ao enviar: cria thread e agenda processamento 1x
-if send and question_text and question_text.strip():
-    st.session_state.threads.insert(0, {
-        "q": question_text.strip(), "a": None, "sql": None,
-        "ts": time.time(), "df_sample": None, "df_cols": None
-    })
-    st.session_state.pending_index = 0
-    st.rerun()
-
-# Processa UMA pendência e salva
-if st.session_state.pending_index is not None:
+# --------- INPUT (topo): Enviar ao lado, Limpar link à direita ---------
+# fragment: interações dentro do cartão não re-renderizam a lista de threads;
+# Enviar/Limpar forçam um rerun completo explícito quando há trabalho a fazer
+@st.fragment
+def render_ask_card():
+    st.markdown('<div class="ask-card">', unsafe_allow_html=True)
+    st.markdown('<div class="send-wrap">', unsafe_allow_html=True)
+    # form: digitar no textarea não dispara rerun a cada tecla — o script só
+    # roda de novo no submit (Enviar ou Ctrl+Enter)
+    with st.form("ask_form", clear_on_submit=False, border=False):
+        col_input, col_send = st.columns([8, 1.6])
+        with col_input:
+            question_text = st.text_area(
+                label=" ",
+                label_visibility="collapsed",
+                height=56,
+                placeholder="Ex.: Performance orgânica de agosto de 2025 para mobile"
+            )
+        with col_send:
+            send = st.form_submit_button("Enviar", use_container_width=True)
+    st.markdown('</div>', unsafe_allow_html=True)
+
+    st.markdown('<div class="clear-wrap">', unsafe_allow_html=True)
+    clear = st.button("Limpar", key="clear_btn")
+    st.markdown('</div>', unsafe_allow_html=True)
+    st.markdown('</div>', unsafe_allow_html=True)
+
+    if clear:
+        st.session_state.threads = []
+        st.session_state.pending_indices = []
+        st.rerun(scope="app")
+
+    # Ao enviar: cria thread e agenda processamento 1x
+    if send and question_text and question_text.strip():
+        st.session_state.threads.insert(0, {
+            "q": question_text.strip(), "a": None, "sql": None,
+            "ts": time.time(), "df_sample": None, "df_cols": None,
+            "executed": False
+        })
+        archive_old_threads()
+        # insert(0) desloca os índices das pendências ainda não processadas
+        st.session_state.pending_indices = [i + 1 for i in st.session_state.pending_indices]
+        st.session_state.pending_indices.append(0)
+        st.rerun(scope="app")
+
+render_ask_card()
+
+# Processa TODAS as pendências num único passe do script (micro-batch por
+# rerun): envios em rajada não pagam um rerun completo cada; threads já
+# executadas nunca disparam SQL de novo
+_pend = [i for i in st.session_state.pending_indices
+         if i < len(st.session_state.threads)
+         and not st.session_state.threads[i].get("executed")]
+st.session_state.pending_indices = []
+
+# rajada de envios: uma única chamada OpenAI gera as SQLs de todas as
+# pendências de uma vez; o loop abaixo só consome o resultado
+_batch_sqls = {}
+if len(_pend) > 1 and client and SA_JSON and not USE_TOOL_CALLS:
+    _batch_idx = [i for i in _pend if len(st.session_state.threads[i]["q"]) >= 6]
+    _sqls = build_sqls_batch(
+        [st.session_state.threads[i]["q"] for i in _batch_idx],
+        BQ_TABLE, get_table_schema(BQ_TABLE),
+    )
+    if _sqls:
+        _batch_sqls = dict(zip(_batch_idx, _sqls))
+
+for _i in _pend:
+    # placeholder do streaming: limpo ao final porque o loop de render logo
+    # abaixo (mesmo passe do script) mostra a resposta definitiva
+    _ph = st.empty()
     try:
-        th = st.session_state.threads[st.session_state.pending_index]
-        schema_cols = get_table_schema(BQ_TABLE) if bq else []
-        sql = build_sql_with_ai(th["q"], BQ_TABLE, schema_cols)
-        if not sql or not sql_is_safe(sql):
-            answer = "Não foi possível gerar uma consulta segura para essa pergunta. Tente especificar período e/ou dimensões (meses, país, device)."
-            df = pd.DataFrame()
+        th = st.session_state.threads[_i]
+        th["executed"] = True
+        # rejeição barata antes de qualquer chamada externa: pergunta curta ou
+        # sem conteúdo alfanumérico nunca vira SQL válida — nem gasta OpenAI
+        if len(th["q"]) < 6 or not re.search(r"[a-zA-Z0-9]", th["q"]):
+            answer = "Pergunta muito curta. Descreva o que quer analisar (ex.: período, device, país)."
+            sql, df = None, pd.DataFrame()
         else:
-            sql = ensure_limit(sql)
-            df = bq.query(sql).result().to_dataframe()
-            answer = ai_summary_paragraph(th["q"], df, sql)
+            # cache semântico e schema são independentes: dispara o lookup em
+            # paralelo e busca o schema enquanto o embedding viaja
+            sem_fut = get_executor().submit(semantic_cache.lookup, client, th["q"]) if client else None
+            schema_cols = get_table_schema(BQ_TABLE) if SA_JSON else []
+            sem_hit = sem_fut.result() if sem_fut else None
+            if USE_TOOL_CALLS and client and SA_JSON and not sem_hit:
+                # fluxo fundido: uma conversa gera a SQL (tool call) e o resumo
+                answer, sql, df = answer_with_tools(th["q"], schema_cols, placeholder=_ph)
+                if sql and not df.empty:
+                    semantic_cache.store(client, th["q"], sql)
+            else:
+                if sem_hit:
+                    sql = sem_hit[0]
+                else:
+                    sql = _batch_sqls.get(_i) or build_sql_with_ai(th["q"], BQ_TABLE, schema_cols)
+                if not sql or not sql_is_safe(sql, BQ_TABLE):
+                    answer = "Não foi possível gerar uma consulta segura para essa pergunta. Tente especificar período e/ou dimensões (meses, país, device)."
+                    df = pd.DataFrame()
+                else:
+                    sql = ensure_limit(optimize_projection(sql, BQ_TABLE, schema_cols))
+                    scan_bytes = dry_run_bytes(sql)
+                    if scan_bytes > MAX_SCAN_BYTES:
+                        answer = (
+                            f"Consulta escanearia {scan_bytes/1e9:.1f} GB "
+                            f"(limite {MAX_SCAN_BYTES/1e9:.1f} GB). "
+                            "Refine o período e/ou as dimensões da pergunta."
+                        )
+                        df = pd.DataFrame()
+                    else:
+                        # consulta roda no pool; o script só faz o poll do
+                        # future e mantém a bolha "Analisando…" viva com o
+                        # tempo decorrido em vez de travar mudo por segundos
+                        _fut = get_executor().submit(run_sql, normalize_sql(sql))
+                        _t0 = time.monotonic()
+                        while not _fut.done():
+                            _ph.markdown(f"Analisando dados… ({time.monotonic() - _t0:.0f}s)")
+                            time.sleep(0.2)
+                        df = _fut.result()
+                        answer = ai_summary_paragraph(th["q"], df, sql, placeholder=_ph)
+                        if client and not sem_hit:
+                            semantic_cache.store(client, th["q"], sql)
         th["a"] = answer
         th["sql"] = sql
         if not df.empty:
             th["df_cols"] = list(df.columns)
-            th["df_sample"] = df.head(300).to_dict(orient="records")
+            th["df_sample"] = sample_to_feather(df)
     except Exception as e:
-        st.session_state.threads[st.session_state.pending_index]["a"] = f"Erro ao consultar: {e}"
-        st.session_state.threads[st.session_state.pending_index]["sql"] = None
+        th["a"] = f"Erro ao consultar: {e}"
+        th["sql"] = None
     finally:
-        st.session_state.pending_index = None
-        st.rerun()
+        _ph.empty()
 
 # --------- RENDER (mais recente → antigo) ---------
+# st.chat_message nativo: 2 deltas de protobuf por turno em vez de ~8
+# st.markdown com HTML — menos tráfego no websocket e diff mais barato
 for th in st.session_state.threads:
-    ts_txt = pd.to_datetime(th["ts"], unit="s").strftime("%Y-%m-%d %H:%M")
-    st.markdown('<div class="qa-block">', unsafe_allow_html=True)
-    st.markdown(
-        f'<div class="qa-head"><span class="avatar">{AVATAR_USER}</span>'
-        f'<span class="label">Pergunta</span>'
-        f'<span class="qa-time">{ts_txt}</span></div>', unsafe_allow_html=True
-    )
-    st.markdown(f'<div class="qa-q">{th["q"]}</div>', unsafe_allow_html=True)
-    st.markdown(
-        f'<div class="qa-head" style="margin-top:6px;"><span class="avatar">{AVATAR_BOT}</span>'
-        f'<span class="label">Análise</span></div>', unsafe_allow_html=True
-    )
-    st.markdown(f'<div class="qa-a">{th["a"] or "Processando…"}</div>', unsafe_allow_html=True)
-
-    if (SHOW_SQL or SHOW_TABLE) and th.get("sql"):
-        with st.expander("Detalhes da consulta"):
-            if SHOW_SQL: st.code(th["sql"], language="sql")
-            if SHOW_TABLE and th.get("df_sample"):
-                try:
-                    df_prev = pd.DataFrame(th["df_sample"], columns=th["df_cols"])
-                    st.dataframe(df_prev, use_container_width=True)
-                except Exception as e:
-                    st.write(f"Falha ao exibir amostra: {e}")
-    st.markdown('</div>', unsafe_allow_html=True)
+    # time.strftime é C puro — sem construir um Timestamp pandas por thread
+    ts_txt = time.strftime("%Y-%m-%d %H:%M", time.localtime(th["ts"]))
+    with st.chat_message("user", avatar=AVATAR_USER):
+        st.markdown(th["q"])
+        st.caption(ts_txt)
+    with st.chat_message("assistant", avatar=AVATAR_BOT):
+        st.markdown(th["a"] or "Processando…")
+        if (SHOW_SQL or SHOW_TABLE) and th.get("sql"):
+            with st.expander("Detalhes da consulta"):
+                if SHOW_SQL: st.code(th["sql"], language="sql")
+                if SHOW_TABLE and th.get("df_sample"):
+                    try:
+                        df_prev = sample_from_feather(th["df_sample"], th["df_cols"])
+                        st.dataframe(df_prev, use_container_width=True)
+                    except Exception as e:
+                        st.write(f"Falha ao exibir amostra: {e}")
+
+# histórico arquivado: carregado do disco só quando o usuário pedir
+if os.path.exists(HISTORY_DB):
+    with st.expander("Histórico anterior"):
+        if st.checkbox("Carregar conversas arquivadas", key="load_archive"):
+            for ts, q, a in load_archived_threads():
+                ts_txt = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts))
+                st.markdown(f"**{ts_txt}** — {q}")
+                st.markdown(a or "_sem resposta_")
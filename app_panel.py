@@ -1,29 +1,18 @@
-import os, re, json, time
+import os, json, time
+import orjson
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
 import pandas as pd
 import streamlit as st
 from html import escape
+from llm_cache import cached_chat, cache_key, cache_get, cache_put
+from sql_helpers import sanitize_sql, sql_is_safe, ensure_limit
 from supermetrics_adapter import (
     instagram_adapter_from_env,
     facebook_pages_adapter_from_env,
 )
-
-
-# ========== EMBED NO LOOKER STUDIO ==========
-try:
-    from streamlit.web.server import websocket_headers as wh
-    _orig_get = wh._get_websocket_headers
-    def _patched_get(*args, **kwargs):
-        headers = _orig_get(*args, **kwargs)
-        headers["Content-Security-Policy"] = (
-            "frame-ancestors 'self' https://lookerstudio.google.com https://datastudio.google.com"
-        )
-        headers.pop("X-Frame-Options", None)
-        return headers
-    wh._get_websocket_headers = _patched_get
-except Exception:
-    pass
-# ============================================
+import embed_patch  # noqa: F401  (patch de headers para embed no Looker Studio)
 
 st.set_page_config(page_title="AI Insights Panel", layout="wide")
 
@@ -37,34 +26,99 @@ if not BQ_TABLE:  st.error("Defina BQ_TABLE (ex.: projeto.dataset.tabela).")
 if not SA_JSON:   st.error("Defina GOOGLE_APPLICATION_CREDENTIALS_JSON (conteúdo do JSON da Service Account).")
 if not OPENAI_KEY: st.warning("Defina OPENAI_API para habilitar a IA.")
 
-# --------- Credencial GCP ---------
-if SA_JSON:
-    SA_PATH = "/tmp/sa.json"
-    with open(SA_PATH, "w") as f:
-        f.write(SA_JSON)
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SA_PATH
+# --------- Credencial GCP (em memória: sem escrever segredo em /tmp) ---------
+@st.cache_resource(show_spinner=False)
+def get_credentials():
+    from google.oauth2 import service_account
+    return service_account.Credentials.from_service_account_info(json.loads(SA_JSON))
 
 # --------- BigQuery ---------
+from google.api_core.exceptions import BadRequest
 from google.cloud import bigquery
 @st.cache_resource(show_spinner=False)
-def get_bq(): return bigquery.Client()
+def get_bq():
+    creds = get_credentials()
+    return bigquery.Client(credentials=creds, project=creds.project_id)
 bq = get_bq() if SA_JSON else None
 
-@st.cache_data(show_spinner=False)
-def get_table_schema(table_fqn: str):
+# Config única para todas as consultas: cache do BQ explícito (repetição de
+# SQL idêntica sai grátis) e teto de bytes escaneados — uma SQL patológica
+# gerada pela IA falha rápido em vez de varrer terabytes. Labels ajudam a
+# achar as consultas pesadas no console de billing.
+JOB_CONFIG = bigquery.QueryJobConfig(
+    use_query_cache=True,
+    use_legacy_sql=False,
+    maximum_bytes_billed=int(os.getenv("BQ_MAX_BYTES", 5 * 2**30)),
+    labels={"app": "analytics-insights"},
+)
+
+@st.cache_resource(show_spinner=False)
+def get_bqstorage():
+    """Cliente do Storage Read API (Arrow) — download colunar, sem REST/JSON."""
+    from google.cloud import bigquery_storage
+    return bigquery_storage.BigQueryReadClient(credentials=get_credentials())
+
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    """Pool compartilhado para sobrepor esperas de rede (schema, LLM)."""
+    return ThreadPoolExecutor(max_workers=4)
+
+SCHEMA_TTL = int(os.getenv("SCHEMA_CACHE_TTL", "3600"))
+
+# persist="disk" ignora o ttl no Streamlit 1.37 (a entrada persistida nunca
+# expira), então o frescor é controlado manualmente: o carimbo fica dentro
+# do valor cacheado e o wrapper refaz o fetch quando ele vence
+@st.cache_data(show_spinner=False, persist="disk")
+def _table_schema_snapshot(table_fqn: str):
     tbl = bq.get_table(table_fqn)
-    return [(s.name, s.field_type) for s in tbl.schema]
+    return time.time(), tuple((s.name, s.field_type) for s in tbl.schema)
+
+def get_table_schema(table_fqn: str):
+    """Schema persistido em disco (cold start de container sem get_table) e
+    renovado quando o snapshot passa de SCHEMA_TTL — mudanças de DDL
+    aparecem em até 1h. Tupla = valor imutável no cache."""
+    fetched_at, schema = _table_schema_snapshot(table_fqn)
+    if time.time() - fetched_at > SCHEMA_TTL:
+        _table_schema_snapshot.clear()
+        _, schema = _table_schema_snapshot(table_fqn)
+    return schema
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def schema_cols_txt(table_fqn: str) -> str:
+    """Bloco "- coluna (TIPO)" pré-formatado uma vez por schema, não por
+    chamada — o prompt só concatena strings prontas."""
+    return "\n".join(f"- {c} ({t})" for c, t in get_table_schema(table_fqn))
+
+# pré-aquece o schema em paralelo com o render da UI: no primeiro Send o
+# get_table já aconteceu em background em vez de entrar no caminho crítico
+if bq and BQ_TABLE:
+    get_executor().submit(get_table_schema, BQ_TABLE)
 
 # --------- OpenAI (sem herdar proxies) ---------
 from openai import OpenAI
 import httpx
-client = None
-if OPENAI_KEY:
-    http_client = httpx.Client(timeout=60.0, follow_redirects=True, trust_env=False)
-    client = OpenAI(api_key=OPENAI_KEY, http_client=http_client)
+
+@st.cache_resource(show_spinner=False)
+def get_openai():
+    """Cliente compartilhado entre reruns: o pool TCP/TLS sobrevive ao ciclo
+    do Streamlit e HTTP/2 multiplexa chamadas concorrentes numa conexão."""
+    if not OPENAI_KEY:
+        return None
+    http_client = httpx.Client(
+        http2=True,
+        timeout=60.0,
+        follow_redirects=True,
+        trust_env=False,
+        limits=httpx.Limits(max_keepalive_connections=10, max_connections=20, keepalive_expiry=60),
+    )
+    return OpenAI(api_key=OPENAI_KEY, http_client=http_client)
+
+client = get_openai()
 
 # --------- STYLE (tema claro, painel estreito como no print) ---------
-st.markdown("""
+# constante de módulo: a string vive no code object e o rerun só repassa a
+# referência para o st.markdown — nada é reconstruído por interação
+_PAGE_CSS = """
 <style>
 /* (1) QUICK PROMPTS: botões claros, como o textarea */
 [data-testid="stAppViewContainer"] .chips .stButton > button {
@@ -109,37 +163,110 @@ li[class*=" st-emotion-cache-"] { margin-bottom: 6% !important; padding: 0px 0px
 .divider{{ height:1px; background:#e5e7eb; margin:.6rem 0; }}
 
 </style>
-""", unsafe_allow_html=True)
-
-# --------- Helpers: SQL ---------
-def sanitize_sql(text: str) -> str:
-    if not text: return ""
-    t = text.strip()
-    t = re.sub(r"^sql\s*", "", t, flags=re.IGNORECASE)
-    t = re.sub(r"^```(?:sql)?\s*|\s*```$", "", t, flags=re.IGNORECASE|re.DOTALL)
-    m = re.search(r"\bselect\b", t, flags=re.IGNORECASE)
-    if m: t = t[m.start():]
-    return t.strip().rstrip(";")
-
-def sql_is_safe(sql: str) -> bool:
-    s = sql.strip().lower()
-    if not re.match(r"^\s*select\b", s): return False
-    forbidden = ["insert","update","delete","merge","drop","create","alter","truncate",";","--","/*"]
-    if any(tok in s for tok in forbidden): return False
-    target_clean = re.sub(r"[`\s]","", BQ_TABLE.lower())
-    s_clean      = re.sub(r"[`\s]","", s)
-    return target_clean in s_clean
-
-def ensure_limit(sql: str, default_limit:int=1000) -> str:
-    return sql if re.search(r"\blimit\b\s+\d+\s*$", sql, re.I) else f"{sql}\nLIMIT {default_limit}"
+"""
+st.markdown(_PAGE_CSS, unsafe_allow_html=True)
+
+# --------- Helpers: SQL (compartilhados em sql_helpers.py) ---------
+
+def preview_sql(sql: str, n: int = 45) -> str:
+    """Embrulha a consulta com um LIMIT pequeno para o caminho dos findings.
+
+    O prompt só consome ~40 linhas; sem isso baixaríamos (e converteríamos)
+    as até 1000 linhas do ensure_limit para depois descartar quase tudo.
+    """
+    return f"SELECT * FROM (\n{sql}\n) LIMIT {n}"
+
+def dry_run_error(sql: str):
+    """Dry-run no BigQuery: valida sintaxe e estima bytes sem executar.
+
+    Retorna None quando a consulta é válida e cabe no teto de bytes; caso
+    contrário, a mensagem de erro — que vira feedback para re-geração.
+    """
+    try:
+        job = bq.query(sql, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+    except Exception as e:
+        return str(e)
+    scanned = job.total_bytes_processed or 0
+    cap = JOB_CONFIG.maximum_bytes_billed
+    if scanned > cap:
+        return f"A consulta escanearia {scanned / 2**30:.1f} GiB (teto: {cap / 2**30:.1f} GiB); restrinja o período ou as colunas."
+    return None
+
+@st.cache_data(show_spinner=False, ttl=900, max_entries=64)
+def fetch_preview_df(sql: str, n: int = 45) -> pd.DataFrame:
+    """Baixa o preview como lotes Arrow e para assim que n linhas chegam.
+
+    query_and_wait + to_arrow_iterable entregam o primeiro RecordBatch sem
+    esperar a materialização do resultado inteiro; a conversão para pandas
+    acontece uma única vez sobre os lotes recortados.
+    """
+    import pyarrow as pa
+    # sem max_results: com ele o RowIterator recusa o bqstorage_client e
+    # volta (com warning) para o REST; o teto de linhas do lado do servidor
+    # já vem do LIMIT n que preview_sql embrulha na consulta
+    rows = bq.query_and_wait(preview_sql(sql, n), job_config=JOB_CONFIG)
+    batches, got = [], 0
+    for batch in rows.to_arrow_iterable(bqstorage_client=get_bqstorage()):
+        batches.append(batch)
+        got += batch.num_rows
+        if got >= n:
+            break
+    if not batches:
+        return pd.DataFrame()
+    # dtypes Arrow: strings (query, page...) ficam em buffers contíguos em
+    # vez de objetos Python (~50B de overhead cada) — 2-4x menos memória e
+    # serialização mais barata no digest do prompt
+    return pa.Table.from_batches(batches).slice(0, n).to_pandas(types_mapper=pd.ArrowDtype)
+
+# --------- Quick prompts: SQL determinística, sem OpenAI ---------
+# os chips sempre enviam o mesmo texto; a SQL deles é conhecida de antemão,
+# então o clique mais comum do painel pula a geração por LLM inteira
+_QUICK_PROMPT_SQL = {
+    "Give me 5 key findings for the current period.": f"""
+SELECT data_date, SUM(clicks) AS clicks, SUM(impressions) AS impressions,
+       SAFE_DIVIDE(SUM(clicks), SUM(impressions)) AS ctr,
+       SAFE_DIVIDE(SUM(sum_top_position), SUM(impressions)) AS position
+FROM `{BQ_TABLE}`
+WHERE data_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 28 DAY)
+GROUP BY data_date
+ORDER BY data_date""",
+    "Summarize performance vs last month in up to 5 findings.": f"""
+SELECT DATE_TRUNC(data_date, MONTH) AS month,
+       SUM(clicks) AS clicks, SUM(impressions) AS impressions,
+       SAFE_DIVIDE(SUM(clicks), SUM(impressions)) AS ctr,
+       SAFE_DIVIDE(SUM(sum_top_position), SUM(impressions)) AS position
+FROM `{BQ_TABLE}`
+WHERE data_date >= DATE_TRUNC(DATE_SUB(CURRENT_DATE(), INTERVAL 1 MONTH), MONTH)
+GROUP BY month
+ORDER BY month""",
+    "Top queries and pages driving the results this period.": f"""
+SELECT query, url, SUM(clicks) AS clicks, SUM(impressions) AS impressions,
+       SAFE_DIVIDE(SUM(clicks), SUM(impressions)) AS ctr
+FROM `{BQ_TABLE}`
+WHERE data_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 28 DAY)
+GROUP BY query, url
+ORDER BY clicks DESC
+LIMIT 40""",
+    "Detect anomalies or significant day-to-day changes worth attention.": f"""
+SELECT data_date, device, SUM(clicks) AS clicks, SUM(impressions) AS impressions,
+       SAFE_DIVIDE(SUM(clicks), SUM(impressions)) AS ctr
+FROM `{BQ_TABLE}`
+WHERE data_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 28 DAY)
+GROUP BY data_date, device
+ORDER BY data_date, device""",
+}
 
 # --------- LLM prompts (gera SQL e depois findings em JSON) ---------
-def build_sql_with_ai(question: str, table_fqn: str, columns: list) -> str:
+# cache_data nas duas chamadas OpenAI: clicar o mesmo chip (ou repetir a
+# pergunta) dentro do TTL não paga novo round-trip nem novos tokens
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=128)
+def build_sql_with_ai(question: str, table_fqn: str, cols_txt: str, retry_hint: str = "") -> str:
     if not client: return ""
-    cols_txt = "\n".join([f"- {c} ({t})" for c, t in columns])
+    # JSON estruturado (mesmo formato do ai_key_findings): o modelo não gasta
+    # tokens com cercas de código e o parse dispensa a dança de regex
     system = (
         "Você é um gerador de SQL para BigQuery. "
-        "Responda SOMENTE com a consulta SQL (sem rótulos, sem explicações, sem cercas de código). "
+        'Responda SOMENTE com JSON no formato {"sql": "..."} contendo a consulta. '
         "Use exclusivamente a tabela e colunas fornecidas; não use outras tabelas, nem DDL/DML."
     )
     user = (
@@ -153,18 +280,67 @@ def build_sql_with_ai(question: str, table_fqn: str, columns: list) -> str:
         f"- Comece diretamente com SELECT.\n\n"
         f"Pergunta do usuário:\n{question}\n"
     )
-    resp = client.chat.completions.create(
+    if retry_hint:
+        user += (
+            "\nA tentativa anterior falhou no dry-run do BigQuery com o erro "
+            f"abaixo; gere uma consulta corrigida:\n{retry_hint}\n"
+        )
+    content = cached_chat(
+        client,
+        [{"role":"system","content":system},{"role":"user","content":user}],
         model=OPENAI_MODEL,
-        messages=[{"role":"system","content":system},{"role":"user","content":user}],
         temperature=0.1,
+        response_format={"type":"json_object"},
+        max_tokens=400,
     )
-    return sanitize_sql(resp.choices[0].message.content.strip())
+    try:
+        return sanitize_sql(str(orjson.loads(content).get("sql", "")))
+    except (ValueError, AttributeError):
+        return sanitize_sql(content)  # modelo fugiu do JSON: trata como texto
+
+# canal de progresso do streaming: escrito pela thread do pipeline, lido
+# pelo loop de polling do Send (um dict módulo-level basta num processo só)
+_GEN_PROGRESS = {"chars": 0}
+
+def summarize_for_llm(df: pd.DataFrame, max_bytes: int = 4096) -> str:
+    """Snapshot colunar compacto do DataFrame para o prompt.
+
+    Agregados por coluna (sum/mean/min/max nas numéricas, top-10 valores nas
+    textuais) + algumas linhas de amostra, em JSON curto — tipicamente 3–10x
+    menos tokens que o CSV bruto e mais sinal para o modelo, que enxerga os
+    totais em vez de ter de somar linhas. O orçamento de bytes é respeitado
+    encolhendo a amostra, nunca os agregados.
+    """
+    # colunas de baixo sinal (valor único — ex.: filtro WHERE ecoado em toda
+    # linha) saem da amostra/top e viram um registro único em "constantes"
+    nuniq = df.nunique(dropna=False)
+    const_cols = [c for c in df.columns if nuniq.get(c, 0) <= 1]
+    constantes = {c: str(df[c].iloc[0]) if len(df) else None for c in const_cols}
+    df = df.drop(columns=const_cols) if const_cols else df
+    num = df.select_dtypes("number")
+    agg = num.agg(["sum", "mean", "min", "max"]).round(3).to_dict() if not num.empty else {}
+    top = {
+        c: df[c].astype(str).value_counts().head(10).to_dict()
+        for c in df.columns if c not in num.columns
+    }
+    for rows in (8, 4, 2, 0):
+        sample_df = df.head(rows).copy()
+        num_cols = sample_df.select_dtypes("number").columns
+        if len(num_cols):
+            sample_df[num_cols] = sample_df[num_cols].round(2)
+        blob = json.dumps(
+            {"n_rows": len(df), "constantes": constantes, "agregados": agg,
+             "top_valores": top, "amostra": sample_df.to_dict(orient="records")},
+            ensure_ascii=False, default=str,
+        )
+        if len(blob.encode("utf-8")) <= max_bytes or rows == 0:
+            return blob
+    return blob
 
-def ai_key_findings(question: str, df: pd.DataFrame, sql_used: str, n:int=5):
-    """Pede findings em JSON: {"findings":[{"title":...,"text":...}]}"""
-    if not client: return [{"title":"Configuração necessária","text":"Defina OPENAI_API."}]
-    if df.empty:   return [{"title":"Sem dados","text":"Não há linhas para o recorte solicitado."}]
-    preview = df.head(40).to_csv(index=False)
+
+def _findings_messages(question: str, df: pd.DataFrame, sql_used: str, n: int):
+    """Monta as messages do prompt de findings (caminho interativo e batch)."""
+    preview = summarize_for_llm(df, max_bytes=int(os.getenv("FINDINGS_CSV_BYTES", "4096")))
     system = (
         "Você é um analista de Marketing/SEO. Gere insights curtos e acionáveis "
         "com base nos dados fornecidos. Responda em JSON válido com a chave 'findings'. "
@@ -175,20 +351,35 @@ def ai_key_findings(question: str, df: pd.DataFrame, sql_used: str, n:int=5):
         f'{{"findings":[{{"title":"...", "text":"..."}}]}}\n\n'
         f"Pergunta do usuário:\n{question}\n\n"
         f"SQL executada (contexto – não comente):\n{sql_used}\n\n"
-        f"Prévia dos resultados (CSV até 40 linhas):\n{preview}"
+        f"Resumo dos resultados (JSON: estatísticas por coluna + amostra):\n{preview}"
     )
-    resp = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[{"role":"system","content":system},{"role":"user","content":user}],
-        temperature=0.2,
-        response_format={"type":"json_object"}
+    return [{"role":"system","content":system},{"role":"user","content":user}]
+
+
+def _findings_html(findings) -> str:
+    """HTML da lista de findings, escapado e concatenado UMA vez, no store.
+
+    O rerun só repassa a string pronta — nada de html.escape por item a
+    cada repintura do painel."""
+    items = "".join(
+        f'<li><span class="kf-item-title">{escape(str(it.get("title","Insight")))}</span>'
+        f'<span class="kf-item-text">{escape(str(it.get("text","")))}</span></li>'
+        for it in findings or []
     )
+    return f'<ol class="kf-list">{items}</ol>'
+
+
+def _parse_findings(content: str, n: int):
+    """Converte a resposta JSON do modelo em findings saneados."""
     try:
-        data = json.loads(resp.choices[0].message.content or "{}")
+        # orjson: decode em C (~2-5x o stdlib); a validação defensiva dos
+        # campos continua no loop abaixo
+        data = orjson.loads(content or "{}")
         findings = data.get("findings", [])
-        # saneamento simples
         out = []
         for it in findings[:n]:
+            if not isinstance(it, dict):
+                continue
             title = str(it.get("title","Insight")).strip()[:120]
             text  = str(it.get("text","")).strip()
             if text:
@@ -196,13 +387,113 @@ def ai_key_findings(question: str, df: pd.DataFrame, sql_used: str, n:int=5):
         return out or [{"title":"Sem insights","text":"Os dados retornados são muito curtos para gerar achados úteis."}]
     except Exception:
         # fallback: tudo em um finding único
-        return [{"title":"Resumo", "text": resp.choices[0].message.content.strip()}]
+        return [{"title":"Resumo", "text": (content or "").strip()}]
+
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=64)
+def ai_key_findings(question: str, df: pd.DataFrame, sql_used: str, n:int=5):
+    """Pede findings em JSON: {"findings":[{"title":...,"text":...}]}"""
+    if not client: return [{"title":"Configuração necessária","text":"Defina OPENAI_API."}]
+    if df.empty:   return [{"title":"Sem dados","text":"Não há linhas para o recorte solicitado."}]
+    # stream=True: os findings são JSON (não dá para renderizar os tokens
+    # crus), mas o acumulado alimenta o contador de progresso que o loop de
+    # polling do Send exibe — o usuário vê a geração andando desde ~300ms
+    messages = _findings_messages(question, df, sql_used, n)
+    key = cache_key(messages, OPENAI_MODEL, 0.2, extra={"response_format": repr({"type":"json_object"})})
+    content = cache_get(key)
+    if content is None:
+        _GEN_PROGRESS["chars"] = 0
+        acc = []
+        stream = client.chat.completions.create(
+            model=OPENAI_MODEL, messages=messages, temperature=0.2,
+            response_format={"type":"json_object"}, stream=True,
+        )
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content or ""
+            if delta:
+                acc.append(delta)
+                _GEN_PROGRESS["chars"] += len(delta)
+        content = "".join(acc).strip()
+        if content:
+            cache_put(key, content)
+        _GEN_PROGRESS["chars"] = 0
+    return _parse_findings(content, n)
+
+# --------- Modo batch (OpenAI Batch API: 50% do custo, janela de 24h) ---------
+# Para relatórios sem pressa: as perguntas entram numa fila e os findings de
+# todas vão num único job /v1/batches — metade do preço por token.
+
+def submit_findings_batch(questions):
+    """Empacota a fila num job do Batch API e retorna o registro para a sessão.
+
+    A SQL + preview de cada pergunta roda aqui mesmo (barata e necessária
+    para montar o prompt); só a geração de findings — a parte cara — vai
+    para o batch.
+    """
+    items, lines = [], []
+    for i, q_user in enumerate(questions):
+        sql = _QUICK_PROMPT_SQL.get(q_user, "").strip()
+        if not sql:
+            sql = build_sql_with_ai(q_user, BQ_TABLE, schema_cols_txt(BQ_TABLE) if bq else "")
+        if not sql or not sql_is_safe(sql, BQ_TABLE):
+            continue
+        sql = ensure_limit(sql)
+        df = fetch_preview_df(sql)
+        body = {
+            "model": OPENAI_MODEL,
+            "messages": _findings_messages(q_user, df, sql, 6),
+            "temperature": 0.2,
+            "response_format": {"type": "json_object"},
+        }
+        lines.append(json.dumps(
+            {"custom_id": str(i), "method": "POST", "url": "/v1/chat/completions", "body": body},
+            ensure_ascii=False,
+        ))
+        items.append({"custom_id": str(i), "q": q_user, "sql": sql})
+    if not lines:
+        return {}
+    up = client.files.create(
+        file=("findings_batch.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    job = client.batches.create(
+        input_file_id=up.id, endpoint="/v1/chat/completions", completion_window="24h",
+    )
+    return {"id": job.id, "items": items, "submitted_at": time.time()}
+
+
+def collect_findings_batch(batch_job):
+    """Confere o job; quando completo, despeja os findings nos insights."""
+    job = client.batches.retrieve(batch_job["id"])
+    if job.status != "completed":
+        st.info(f"Batch ainda em `{job.status}` — verifique de novo em alguns minutos.")
+        return False
+    raw = client.files.content(job.output_file_id).content
+    by_id = {}
+    for line in raw.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        rec = json.loads(line)
+        content = (rec.get("response", {}).get("body", {})
+                      .get("choices", [{}])[0].get("message", {}).get("content", ""))
+        by_id[rec.get("custom_id")] = content
+    for it in batch_job["items"]:
+        batch_findings = _parse_findings(by_id.get(it["custom_id"], ""), 6)
+        st.session_state.insights.appendleft({
+            "q": it["q"], "findings": batch_findings, "html": _findings_html(batch_findings),
+            "ts": time.time(), "sql": it["sql"],
+        })
+    return True
 
 # --------- STATE ---------
 if "insights" not in st.session_state:
-    st.session_state.insights = []   # lista de blocos: {q:str, findings:[{title,text}], ts:float, sql:str}
-if "pending" not in st.session_state:
-    st.session_state.pending = None  # índice do insight a processar
+    # deque: appendleft O(1) (insert(0) em lista desloca tudo) e maxlen
+    # limita a memória/pickle do session_state em sessões longas
+    st.session_state.insights = deque(maxlen=50)  # blocos: {q:str, findings:[{title,text}], ts:float, sql:str}
+if "batch_queue" not in st.session_state:
+    st.session_state.batch_queue = []   # perguntas aguardando envio em batch
+if "batch_job" not in st.session_state:
+    st.session_state.batch_job = None   # {id, items, submitted_at} do job ativo
 
 # --------- UI: Header + fonte de dados ---------
 st.markdown("### Generative Insights")
@@ -248,9 +539,33 @@ with st.container():
         st.markdown('<div class="btn-secondary">', unsafe_allow_html=True)
         clear = st.button("Clear insights", use_container_width=True)
         st.markdown('</div>', unsafe_allow_html=True)
+        # modo não-interativo: enfileira em vez de processar (Batch API, 50% do custo)
+        batch_mode = st.toggle("Queue for batch", value=False,
+                               help="Acumula perguntas e gera os findings via OpenAI Batch API (metade do custo, resultado em até 24h). Apenas fonte GSC.")
 
     st.markdown('</div>', unsafe_allow_html=True)  # fecha panel-card
 
+# --------- Fila de batch (visível só quando há algo nela) ---------
+if st.session_state.batch_queue or st.session_state.batch_job:
+    with st.container():
+        if st.session_state.batch_queue:
+            st.caption(f"Fila de batch: {len(st.session_state.batch_queue)} pergunta(s)")
+            if st.button("Submit batch", key="batch_submit") and client:
+                job = submit_findings_batch(st.session_state.batch_queue)
+                if job:
+                    st.session_state.batch_job = job
+                    st.session_state.batch_queue = []
+                    st.rerun()
+                else:
+                    st.warning("Nenhuma pergunta da fila gerou SQL válida.")
+        if st.session_state.batch_job:
+            st.caption(f"Batch `{st.session_state.batch_job['id']}` em andamento "
+                       f"({len(st.session_state.batch_job['items'])} item(ns))")
+            if st.button("Check batch results", key="batch_check") and client:
+                if collect_findings_batch(st.session_state.batch_job):
+                    st.session_state.batch_job = None
+                    st.rerun()
+
 # Chips preenchem e enviam
 if chip1: q, send = "Give me 5 key findings for the current period.", True
 if chip2: q, send = "Summarize performance vs last month in up to 5 findings.", True
@@ -259,110 +574,128 @@ if chip4: q, send = "Detect anomalies or significant day-to-day changes worth at
 
 # Limpar
 if clear:
-    st.session_state.insights = []
-    st.session_state.pending = None
-    st.rerun()
-
-# Enfileira um insight para processar
-if send and q and q.strip():
-    st.session_state.insights.insert(0, {"q": q.strip(), "findings": None, "ts": time.time(), "sql": None})
-    st.session_state.pending = 0
+    st.session_state.insights.clear()
     st.rerun()
 
-# Processa UMA pendência
-if st.session_state.pending is not None:
-    idx = st.session_state.pending
-    try:
-        q_user = st.session_state.insights[idx]["q"]
-        current_source = source  # pega a fonte selecionada na UI
-
-        if current_source.startswith("Google Search Console"):
-            # --- fluxo original: BigQuery + SQL ---
-            schema_cols = get_table_schema(BQ_TABLE) if bq else []
-            sql = build_sql_with_ai(q_user, BQ_TABLE, schema_cols)
-            if not sql or not sql_is_safe(sql):
-                st.session_state.insights[idx]["findings"] = [
-                    {"title":"Consulta inválida","text":"Não foi possível gerar uma SQL segura. Refine a pergunta."}
-                ]
-                st.session_state.insights[idx]["sql"] = sql or ""
-            else:
-                sql = ensure_limit(sql)
-                df  = bq.query(sql).result().to_dataframe()
-                findings = ai_key_findings(q_user, df, sql, n=6)
-                st.session_state.insights[idx]["findings"] = findings
-                st.session_state.insights[idx]["sql"] = sql
-
-        elif current_source.startswith("Instagram"):
-            ig = instagram_adapter_from_env()
-        
-            # Lê campos e faixas de data das ENVs
-            fields_env = os.getenv(
-                "IGI_FIELDS",
-                "month,followers_count,follows_count"
-            ).split(",")
-        
-            # Se a dimensão "month" estiver nos campos, não force granularity=day
-            has_month = any(f.strip().lower() == "month" for f in fields_env)
-            gran = None if has_month else "day"
-        
-            # Se você definiu IGI_DATE_RANGE_TYPE, priorize-o (mais robusto para IGI)
-            drt = (os.getenv("IGI_DATE_RANGE_TYPE") or "").strip() or None
-        
-            if drt:
-                df = ig.query(
-                    fields=[f.strip() for f in fields_env],
-                    date_range_type=drt,
-                    time_granularity=gran
-                )
-                sql_ctx = f"Supermetrics IGI fields={','.join([f.strip() for f in fields_env])} range={drt}"
-            else:
-                # fallback: últimos 30 dias (se não houver IGI_DATE_RANGE_TYPE)
-                end = date.today()
-                start = end - timedelta(days=30)
-                df = ig.query(
-                    fields=[f.strip() for f in fields_env],
-                    date_from=start.isoformat(),
-                    date_to=end.isoformat(),
-                    time_granularity=gran
-                )
-                sql_ctx = f"Supermetrics IGI fields={','.join([f.strip() for f in fields_env])} {start}..{end}"
-        
-            findings = ai_key_findings(q_user, df, sql_ctx, n=6)
-            st.session_state.insights[idx]["findings"] = findings
-            st.session_state.insights[idx]["sql"] = "Supermetrics (IGI)"
-
-        
-        elif current_source.startswith("Facebook"):
-            # --- Supermetrics: Facebook Pages (FBI/FPI) ---
-            fb = facebook_pages_adapter_from_env()
-            from datetime import date, timedelta
+def process_question(q_user: str, current_source: str):
+    """Pipeline completo de um Send: retorna (findings, sql_usada).
+
+    Roda inline no mesmo passe do script — sem o pingue-pongue
+    enfileira → rerun → processa → rerun de antes.
+    """
+    if current_source.startswith("Google Search Console"):
+        # --- fluxo original: BigQuery + SQL ---
+        # chips têm SQL pronta: nem schema nem OpenAI no caminho
+        sql = _QUICK_PROMPT_SQL.get(q_user, "").strip()
+        if not sql:
+            sql = build_sql_with_ai(q_user, BQ_TABLE, schema_cols_txt(BQ_TABLE) if bq else "")
+        if not sql or not sql_is_safe(sql, BQ_TABLE):
+            return ([{"title":"Consulta inválida","text":"Não foi possível gerar uma SQL segura. Refine a pergunta."}],
+                    sql or "")
+        sql = ensure_limit(sql)
+        # dry-run pega SQL quebrada (ou cara demais) por ~100ms em vez de
+        # descobrir na execução real; o erro realimenta UMA re-geração
+        err = dry_run_error(sql) if bq else None
+        if err and q_user not in _QUICK_PROMPT_SQL:
+            sql = build_sql_with_ai(q_user, BQ_TABLE, schema_cols_txt(BQ_TABLE), retry_hint=err)
+            if not sql or not sql_is_safe(sql, BQ_TABLE):
+                return ([{"title":"Consulta inválida","text": err}], sql or "")
+            sql = ensure_limit(sql)
+            err = dry_run_error(sql)
+        if err:
+            return ([{"title":"Consulta inválida","text": err}], sql)
+        try:
+            df = fetch_preview_df(sql)
+        except BadRequest as e:
+            if "bytes" in str(e).lower():
+                # estourou maximum_bytes_billed na execução real (o dry-run
+                # subestima): devolve um finding amigável, não um traceback
+                return ([{"title":"Consulta acima do orçamento",
+                          "text":"A consulta excede o teto de bytes configurado (BQ_MAX_BYTES). Restrinja o período ou as colunas."}], sql)
+            raise
+        return ai_key_findings(q_user, df, sql, n=6), sql
+
+    if current_source.startswith("Instagram"):
+        ig = instagram_adapter_from_env()
+
+        # Lê campos e faixas de data das ENVs
+        fields_env = os.getenv(
+            "IGI_FIELDS",
+            "month,followers_count,follows_count"
+        ).split(",")
+
+        # Se a dimensão "month" estiver nos campos, não force granularity=day
+        has_month = any(f.strip().lower() == "month" for f in fields_env)
+        gran = None if has_month else "day"
+
+        # Se você definiu IGI_DATE_RANGE_TYPE, priorize-o (mais robusto para IGI)
+        drt = (os.getenv("IGI_DATE_RANGE_TYPE") or "").strip() or None
+
+        if drt:
+            df = ig.query(
+                fields=[f.strip() for f in fields_env],
+                date_range_type=drt,
+                time_granularity=gran
+            )
+            sql_ctx = f"Supermetrics IGI fields={','.join([f.strip() for f in fields_env])} range={drt}"
+        else:
+            # fallback: últimos 30 dias (se não houver IGI_DATE_RANGE_TYPE)
             end = date.today()
             start = end - timedelta(days=30)
-            fields = os.getenv("FPI_FIELDS",
-                "date,page_id,post_id,permalink,post_type,message,post_reach,post_impressions,post_engaged_users,reactions_total,comments,shares,link_clicks,video_views"
-            ).split(",")
-            df = fb.query(
-                fields=[f.strip() for f in fields],
+            df = ig.query(
+                fields=[f.strip() for f in fields_env],
                 date_from=start.isoformat(),
                 date_to=end.isoformat(),
-                time_granularity="day"
+                time_granularity=gran
             )
-            findings = ai_key_findings(q_user, df, f"Supermetrics FB fields={','.join(fields)} {start}..{end}", n=6)
-            st.session_state.insights[idx]["findings"] = findings
-            st.session_state.insights[idx]["sql"] = "Supermetrics (FB)"
+            sql_ctx = f"Supermetrics IGI fields={','.join([f.strip() for f in fields_env])} {start}..{end}"
+
+        return ai_key_findings(q_user, df, sql_ctx, n=6), "Supermetrics (IGI)"
+
+    if current_source.startswith("Facebook"):
+        # --- Supermetrics: Facebook Pages (FBI/FPI) ---
+        fb = facebook_pages_adapter_from_env()
+        end = date.today()
+        start = end - timedelta(days=30)
+        fields = os.getenv("FPI_FIELDS",
+            "date,page_id,post_id,permalink,post_type,message,post_reach,post_impressions,post_engaged_users,reactions_total,comments,shares,link_clicks,video_views"
+        ).split(",")
+        df = fb.query(
+            fields=[f.strip() for f in fields],
+            date_from=start.isoformat(),
+            date_to=end.isoformat(),
+            time_granularity="day"
+        )
+        return ai_key_findings(q_user, df, f"Supermetrics FB fields={','.join(fields)} {start}..{end}", n=6), "Supermetrics (FB)"
 
-        else:
-            st.session_state.insights[idx]["findings"] = [
-                {"title":"Fonte não suportada","text":"Selecione GSC, Instagram ou Facebook."}
-            ]
-            st.session_state.insights[idx]["sql"] = ""
+    return ([{"title":"Fonte não suportada","text":"Selecione GSC, Instagram ou Facebook."}], "")
+
+# Processa inline no mesmo passe, mas fora da thread do script: o pipeline
+# roda no executor enquanto esta thread atualiza o feedback com o tempo
+# decorrido — a espera de rede (OpenAI/BQ/Supermetrics) não congela a UI
+if send and q and q.strip() and batch_mode and source.startswith("Google Search Console"):
+    st.session_state.batch_queue.append(q.strip())
+    st.rerun()
 
+if send and q and q.strip():
+    q_user = q.strip()
+    _ph = st.empty()
+    _t0 = time.monotonic()
+    _fut = get_executor().submit(process_question, q_user, source)
+    try:
+        while not _fut.done():
+            _msg = f"Generating insights… ({time.monotonic() - _t0:.0f}s)"
+            if _GEN_PROGRESS["chars"]:
+                _msg += f" · {_GEN_PROGRESS['chars']} caracteres gerados"
+            _ph.markdown(_msg)
+            time.sleep(0.2)
+        findings, sql_used = _fut.result()
     except Exception as e:
-        st.session_state.insights[idx]["findings"] = [{"title":"Erro ao consultar","text": str(e)}]
-        st.session_state.insights[idx]["sql"] = ""
+        findings, sql_used = [{"title":"Erro ao consultar","text": str(e)}], ""
     finally:
-        st.session_state.pending = None
-        st.rerun()
+        _ph.empty()
+    st.session_state.insights.appendleft({"q": q_user, "findings": findings, "html": _findings_html(findings),
+                                          "ts": time.time(), "sql": sql_used})
 
 # --------- Render: Key Findings (mais recente) ---------
 if st.session_state.insights:
@@ -373,17 +706,10 @@ if st.session_state.insights:
     if block["findings"] is None:
         st.write("Gerando insights…")
     else:
-        st.markdown('<ol class="kf-list">', unsafe_allow_html=True)
-        for it in block["findings"]:
-            title = escape(str(it.get("title","Insight")))
-            text  = escape(str(it.get("text","")))
-
-            st.markdown(
-                f'<li><span class="kf-item-title">{title}</span>'
-                f'<span class="kf-item-text">{text}</span></li>',
-                unsafe_allow_html=True
-            )
-        st.markdown('</ol>', unsafe_allow_html=True)
+        # HTML pré-montado no store (_findings_html): um único st.markdown
+        # por repintura, sem escapar/concatenar de novo a cada rerun
+        html = block.get("html") or _findings_html(block["findings"])
+        st.markdown(html, unsafe_allow_html=True)
     st.markdown('</div>', unsafe_allow_html=True)
 
 
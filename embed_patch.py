@@ -0,0 +1,28 @@
+# embed_patch.py
+"""Patch dos headers de websocket para embed no Looker Studio.
+
+Antes cada app carregava sua própria cópia do try/except; uma cópia só
+elimina o risco de embrulhar _get_websocket_headers duas vezes entre
+reloads e tira o bloco duplicado do cold-start dos apps.
+"""
+from __future__ import annotations
+
+_PATCHED = False
+
+try:
+    if not _PATCHED:
+        from streamlit.web.server import websocket_headers as wh
+        _orig_get = wh._get_websocket_headers
+
+        def _patched_get(*args, **kwargs):
+            headers = _orig_get(*args, **kwargs)
+            headers["Content-Security-Policy"] = (
+                "frame-ancestors 'self' https://lookerstudio.google.com https://datastudio.google.com"
+            )
+            headers.pop("X-Frame-Options", None)
+            return headers
+
+        wh._get_websocket_headers = _patched_get
+        _PATCHED = True
+except Exception:
+    pass
@@ -0,0 +1,192 @@
+# llm_cache.py
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+# Cache exato (chave determinística) para respostas do chat.completions.
+# Evita pagar latência/custo da OpenAI em reruns do Streamlit com o mesmo prompt.
+
+CACHE_PATH     = os.getenv("LLM_CACHE_PATH", "/tmp/llm_cache.sqlite3")
+CACHE_TTL      = int(os.getenv("LLM_CACHE_TTL", "86400"))       # 24h
+CACHE_MAX_ROWS = int(os.getenv("LLM_CACHE_MAX_ROWS", "2048"))   # LRU aproximado
+
+# memo em processo: hit vira lookup de dict (µs), sem tocar no disco.
+# LRU limitado com o mesmo TTL do disco (carimbo dentro da entrada) — sem
+# isso um processo Streamlit longevo nunca expirava nada e crescia por
+# prompt distinto
+_MEM: "OrderedDict[str, tuple]" = OrderedDict()
+_MEM_MAX = int(os.getenv("LLM_CACHE_MEM_MAX", "256"))
+
+
+def _mem_get(key: str) -> Optional[str]:
+    entry = _MEM.get(key)
+    if entry is None:
+        return None
+    created_at, response = entry
+    if time.time() - created_at > CACHE_TTL:
+        _MEM.pop(key, None)
+        return None
+    _MEM.move_to_end(key)
+    return response
+
+
+def _mem_put(key: str, response: str, created_at: Optional[float] = None) -> None:
+    _MEM[key] = (created_at if created_at is not None else time.time(), response)
+    _MEM.move_to_end(key)
+    while len(_MEM) > _MEM_MAX:
+        _MEM.popitem(last=False)
+
+
+def _connect() -> sqlite3.Connection:
+    con = sqlite3.connect(CACHE_PATH, timeout=5.0)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS llm_cache ("
+        "  key TEXT PRIMARY KEY,"
+        "  response TEXT NOT NULL,"
+        "  created_at REAL NOT NULL,"
+        "  last_used REAL NOT NULL DEFAULT 0)"
+    )
+    try:  # migra bases criadas antes da coluna last_used
+        con.execute("ALTER TABLE llm_cache ADD COLUMN last_used REAL NOT NULL DEFAULT 0")
+    except sqlite3.OperationalError:
+        pass
+    return con
+
+
+def cache_key(messages: List[Dict[str, str]], model: str, temperature: float,
+              extra: Optional[Dict[str, Any]] = None) -> str:
+    """Chave SHA-256 sobre (model, messages, temperature) canonicalizados.
+
+    Canonicalização: NFC no conteúdo, role/model em minúsculas, JSON com
+    chaves ordenadas — o mesmo prompt gera sempre a mesma chave.
+    """
+    canon: Dict[str, Any] = {
+        "model": (model or "").strip().lower(),
+        "temperature": round(float(temperature), 4),
+        "messages": [
+            {
+                "role": str(m.get("role", "")).strip().lower(),
+                "content": unicodedata.normalize("NFC", str(m.get("content", ""))),
+            }
+            for m in messages
+        ],
+    }
+    if extra:
+        canon["extra"] = extra
+    blob = json.dumps(canon, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def cache_get(key: str) -> Optional[str]:
+    hit = _mem_get(key)
+    if hit is not None:
+        return hit
+    try:
+        con = _connect()
+        row = con.execute(
+            "SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        response, created_at = row
+        if time.time() - created_at > CACHE_TTL:
+            con.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            con.commit()
+            return None
+        # recência só em last_used: created_at fica imutável para o TTL medir
+        # frescor de verdade (tocar created_at tornava entradas quentes eternas)
+        con.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        con.commit()
+        _mem_put(key, response, created_at)
+        return response
+    except sqlite3.Error:
+        return None
+    finally:
+        try:
+            con.close()
+        except Exception:
+            pass
+
+
+def cache_put(key: str, response: str) -> None:
+    _mem_put(key, response)
+    try:
+        con = _connect()
+        now = time.time()
+        con.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, response, created_at, last_used)"
+            " VALUES (?, ?, ?, ?)",
+            (key, response, now, now),
+        )
+        # poda: TTL vencido (por created_at) + excedente além de
+        # CACHE_MAX_ROWS (menos usados recentemente primeiro)
+        con.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - CACHE_TTL,))
+        con.execute(
+            "DELETE FROM llm_cache WHERE key IN ("
+            "  SELECT key FROM llm_cache ORDER BY last_used DESC"
+            "  LIMIT -1 OFFSET ?)",
+            (CACHE_MAX_ROWS,),
+        )
+        con.commit()
+    except sqlite3.Error:
+        pass  # cache é melhor-esforço; nunca derruba a chamada
+    finally:
+        try:
+            con.close()
+        except Exception:
+            pass
+
+
+# single-flight: pedidos idênticos em voo (duplo clique no Send, dois chips
+# em sequência) compartilham a MESMA chamada em vez de pagar duas
+_INFLIGHT: Dict[str, Future] = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def cached_chat(client, messages: List[Dict[str, str]], model: str,
+                temperature: float, **kwargs) -> str:
+    """Envolve client.chat.completions.create com cache exato (memória + disco).
+
+    kwargs extras (ex.: response_format) entram na chave e são repassados.
+    Chamadas idênticas concorrentes são coalescidas: a primeira faz a
+    requisição, as demais bloqueiam no mesmo Future e recebem o resultado.
+    """
+    extra = {k: repr(v) for k, v in sorted(kwargs.items())} or None
+    key = cache_key(messages, model, temperature, extra=extra)
+    hit = cache_get(key)
+    if hit is not None:
+        return hit
+
+    with _INFLIGHT_LOCK:
+        fut = _INFLIGHT.get(key)
+        owner = fut is None
+        if owner:
+            fut = Future()
+            _INFLIGHT[key] = fut
+    if not owner:
+        return fut.result()
+
+    try:
+        resp = client.chat.completions.create(
+            model=model, messages=messages, temperature=temperature, **kwargs
+        )
+        content = (resp.choices[0].message.content or "").strip()
+        if content:
+            cache_put(key, content)
+        fut.set_result(content)
+        return content
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
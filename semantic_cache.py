@@ -0,0 +1,151 @@
+# semantic_cache.py
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# Cache semântico: perguntas parafraseadas ("top 10 queries mobile BR" vs.
+# "melhores 10 consultas mobile no Brasil") reutilizam a SQL (e resumo) já
+# gerados quando a similaridade de embeddings passa do limiar.
+
+EMBED_MODEL    = os.getenv("SEM_CACHE_EMBED_MODEL", "text-embedding-3-small")
+CACHE_PATH     = os.getenv("SEM_CACHE_PATH", "/tmp/semantic_cache.sqlite3")
+CACHE_TTL      = int(os.getenv("SEM_CACHE_TTL", "86400"))
+SIM_THRESHOLD  = float(os.getenv("SEM_CACHE_THRESHOLD", "0.92"))
+MAX_CANDIDATES = int(os.getenv("SEM_CACHE_MAX_ROWS", "512"))
+
+
+def _connect() -> sqlite3.Connection:
+    con = sqlite3.connect(CACHE_PATH, timeout=5.0)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS sem_cache ("
+        "  question TEXT PRIMARY KEY,"
+        "  embedding TEXT NOT NULL,"
+        "  sql TEXT NOT NULL,"
+        "  summary TEXT,"
+        "  created_at REAL NOT NULL)"
+    )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings ("
+        "  key TEXT PRIMARY KEY,"
+        "  vector TEXT NOT NULL,"
+        "  created_at REAL NOT NULL)"
+    )
+    return con
+
+
+# memo em processo: o mesmo texto na mesma sessão nem toca o disco
+_EMB_MEM: Dict[str, np.ndarray] = {}
+
+
+def embed(client, text: str) -> np.ndarray:
+    """Embedding L2-normalizado da pergunta (cosseno vira produto escalar).
+
+    Memoizado por SHA-256 do texto (memória + disco): perguntas repetidas
+    ou reenviadas não pagam a chamada de embeddings de novo.
+    """
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    if key in _EMB_MEM:
+        return _EMB_MEM[key]
+    try:
+        con = _connect()
+        row = con.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            vec = np.asarray(json.loads(row[0]), dtype=np.float32)
+            _EMB_MEM[key] = vec
+            return vec
+    except sqlite3.Error:
+        row = None
+    finally:
+        try:
+            con.close()
+        except Exception:
+            pass
+
+    resp = client.embeddings.create(model=EMBED_MODEL, input=text)
+    vec = np.asarray(resp.data[0].embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    if norm:
+        vec = vec / norm
+    _EMB_MEM[key] = vec
+    try:
+        con = _connect()
+        con.execute(
+            "INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+            (key, json.dumps(vec.tolist()), time.time()),
+        )
+        con.commit()
+    except sqlite3.Error:
+        pass
+    finally:
+        try:
+            con.close()
+        except Exception:
+            pass
+    return vec
+
+
+def lookup(client, question: str) -> Optional[Tuple[str, Optional[str], float]]:
+    """Retorna (sql, summary, similaridade) da pergunta mais próxima, ou None.
+
+    Busca exaustiva vetorizada sobre os embeddings armazenados — para algumas
+    centenas de perguntas isso é sub-milissegundo, sem dependência de ANN.
+    """
+    try:
+        con = _connect()
+        rows = con.execute(
+            "SELECT question, embedding, sql, summary FROM sem_cache"
+            " WHERE created_at > ? ORDER BY created_at DESC LIMIT ?",
+            (time.time() - CACHE_TTL, MAX_CANDIDATES),
+        ).fetchall()
+    except sqlite3.Error:
+        return None
+    finally:
+        try:
+            con.close()
+        except Exception:
+            pass
+    if not rows:
+        return None
+
+    try:
+        q_vec = embed(client, question)
+        mat = np.asarray([json.loads(r[1]) for r in rows], dtype=np.float32)
+        sims = mat @ q_vec
+        best = int(np.argmax(sims))
+        if float(sims[best]) < SIM_THRESHOLD:
+            return None
+        _, _, sql, summary = rows[best]
+        return sql, summary, float(sims[best])
+    except Exception:
+        # embed() chama a API da OpenAI: falha vira miss, como no store —
+        # o cache nunca pode derrubar o fluxo da pergunta
+        return None
+
+
+def store(client, question: str, sql: str, summary: Optional[str] = None) -> None:
+    if not question or not sql:
+        return
+    try:
+        vec = embed(client, question)
+        con = _connect()
+        con.execute(
+            "INSERT OR REPLACE INTO sem_cache"
+            " (question, embedding, sql, summary, created_at) VALUES (?, ?, ?, ?, ?)",
+            (question, json.dumps(vec.tolist()), sql, summary, time.time()),
+        )
+        con.execute("DELETE FROM sem_cache WHERE created_at < ?", (time.time() - CACHE_TTL,))
+        con.commit()
+    except Exception:
+        pass  # melhor-esforço, como o cache exato
+    finally:
+        try:
+            con.close()
+        except Exception:
+            pass
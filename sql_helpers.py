@@ -0,0 +1,141 @@
+# sql_helpers.py
+"""Helpers de SQL compartilhados por app.py e app_panel.py.
+
+Antes cada app carregava sua própria cópia de sanitize_sql/sql_is_safe/
+ensure_limit; uma cópia só significa menos bytecode para carregar e um
+único lugar para evoluir a validação.
+"""
+from __future__ import annotations
+
+import logging
+import re
+from functools import lru_cache
+
+import sqlglot
+import sqlglot.errors
+
+_LOG = logging.getLogger(__name__)
+
+# regexes compilados uma vez no import — fora do caminho quente dos reruns
+_SQL_PREFIX_RE = re.compile(r"^sql\s*", re.IGNORECASE)
+_FENCE_RE      = re.compile(r"^```(?:sql)?\s*|\s*```$", re.IGNORECASE | re.DOTALL)
+_SELECT_RE     = re.compile(r"\bselect\b", re.IGNORECASE)
+_LIMIT_TAIL_RE = re.compile(r"\blimit\b\s+\d+\s*$", re.IGNORECASE)
+_WS_RE         = re.compile(r"\s+")
+
+# pré-filtro barato: uma varredura em C sobre a SQL inteira antes do parse
+_BAD_RE = re.compile(
+    r"\b(?:insert|update|delete|merge|drop|create|alter|truncate)\b|--|/\*|;",
+    re.IGNORECASE,
+)
+
+_FORBIDDEN_EXPS = (
+    sqlglot.exp.Insert, sqlglot.exp.Update, sqlglot.exp.Delete, sqlglot.exp.Merge,
+    sqlglot.exp.Create, sqlglot.exp.Drop, sqlglot.exp.Alter, sqlglot.exp.TruncateTable,
+    sqlglot.exp.Command,
+)
+
+
+def sanitize_sql(text: str) -> str:
+    if not text: return ""
+    t = text.strip()
+    t = _SQL_PREFIX_RE.sub("", t)
+    t = _FENCE_RE.sub("", t)
+    m = _SELECT_RE.search(t)
+    if m: t = t[m.start():]
+    return t.strip().rstrip(";")
+
+
+@lru_cache(maxsize=8)
+def _clean_target(table_fqn: str) -> str:
+    """Normaliza o FQN alvo uma vez por processo (BQ_TABLE quase nunca muda)."""
+    return table_fqn.lower().replace("`", "")
+
+
+@lru_cache(maxsize=256)
+def sql_is_safe(sql: str, table_fqn: str) -> bool:
+    """Valida a SQL gerada pela IA via AST (sqlglot) em vez de regex/substring.
+
+    Aceita apenas um SELECT cuja(s) tabela(s) sejam exatamente table_fqn;
+    qualquer DDL/DML, multi-statement ou SQL que não parseia é rejeitado.
+    Memoizado: a mesma SQL (reenvio, cache semântico) não paga outro parse.
+    """
+    if not sql or not sql.strip():
+        return False
+    if _BAD_RE.search(sql):
+        return False
+    try:
+        statements = sqlglot.parse(sql, read="bigquery")
+    except sqlglot.errors.ParseError:
+        return False
+    if len(statements) != 1 or statements[0] is None:
+        return False
+    tree = statements[0]
+    if not isinstance(tree, sqlglot.exp.Select):
+        return False
+    if any(tree.find(e) for e in _FORBIDDEN_EXPS):
+        return False
+    target = _clean_target(table_fqn)
+    ctes = {c.alias_or_name.lower() for c in tree.find_all(sqlglot.exp.CTE)}
+    tables = list(tree.find_all(sqlglot.exp.Table))
+    if not tables:
+        return False
+    saw_target = False
+    for t in tables:
+        name = ".".join(p.name for p in t.parts).lower()
+        if name == target:
+            saw_target = True
+        elif name not in ctes:
+            return False
+    return saw_target
+
+
+def ensure_limit(sql: str, default_limit: int = 1000) -> str:
+    """Garante um LIMIT na consulta externa via AST.
+
+    O append textual quebrava consultas terminadas em OFFSET ou comentário
+    e não enxergava LIMIT fora do fim do texto; o rewrite via sqlglot
+    injeta o LIMIT no nó certo. Falha de parse cai no append antigo.
+    """
+    if _LIMIT_TAIL_RE.search(sql):  # caminho rápido: LIMIT já está no fim
+        return sql
+    try:
+        tree = sqlglot.parse_one(sql, read="bigquery")
+        if tree.args.get("limit"):
+            return sql
+        return tree.limit(default_limit).sql(dialect="bigquery")
+    except Exception:
+        return f"{sql}\nLIMIT {default_limit}"
+
+
+def normalize_sql(sql: str) -> str:
+    """Normaliza espaços para que variações triviais caiam na mesma chave."""
+    return _WS_RE.sub(" ", sql).strip()
+
+
+def optimize_projection(sql: str, table_fqn: str, columns: list) -> str:
+    """Expande SELECT * e empurra a projeção mínima para as subconsultas.
+
+    O BigQuery cobra por bytes de coluna lidos; quando a IA superseleciona,
+    este passe reduz o scan e o DataFrame resultante. Falha de otimização
+    devolve a SQL original (logada) — o passe nunca bloqueia a consulta.
+    """
+    if not columns:
+        return sql
+    try:
+        from sqlglot.optimizer.qualify import qualify
+        from sqlglot.optimizer.pushdown_projections import pushdown_projections
+        # o MappingSchema exige a forma ANINHADA {proj: {dataset: {tabela:
+        # cols}}}; a chave pontilhada plana não resolve coluna nenhuma e o
+        # qualify falharia em toda chamada
+        schema: dict = {c: t for c, t in columns}
+        for part in reversed(_clean_target(table_fqn).split(".")):
+            schema = {part: schema}
+        tree = sqlglot.parse_one(sql, read="bigquery")
+        tree = qualify(tree, schema=schema, dialect="bigquery")
+        tree = pushdown_projections(tree, schema=schema)
+        return tree.sql(dialect="bigquery")
+    except (sqlglot.errors.SqlglotError, ValueError, KeyError) as e:
+        # erro sistemático aqui significa passe morto: deixa rastro no log
+        _LOG.warning("optimize_projection falhou (%s); usando a SQL original", e)
+        return sql